@@ -1,17 +1,22 @@
 import logging
-from fastapi import FastAPI, Request, HTTPException
+from api.logging_setup import configure_logging
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi.responses import JSONResponse
 from lib.github_utils import get_pr_files
 from lib.orchestrator import generate_readme_from_diff as orchestrator_generate_readme
+from lib.vector_search import ensure_chunk_index_async, get_motor_db
 # from lib.agent import run_sanjaya_agent  <-- Import Person 2's function later
 import os
-import json
-import base64
-import requests
+import sys
+import orjson
+import asyncio
+import httpx
 import hmac
 import hashlib
-from typing import Dict, Any, Optional
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, Tuple
 from dataclasses import dataclass
-from fastapi import FastAPI, Request, HTTPException
 import uvicorn
 from dotenv import load_dotenv
 
@@ -22,6 +27,7 @@ load_dotenv(os.path.join(BASE_DIR, ".env"))
 GITHUB_TOKEN = os.environ["GITHUB_TOKEN"]
 GITHUB_API_BASE = "https://api.github.com"
 GITHUB_WEBHOOK_SECRET = os.environ.get("GITHUB_WEBHOOK_SECRET", "")  # Optional
+_SECRET_BYTES = GITHUB_WEBHOOK_SECRET.encode()
 
 @dataclass
 class PRResult:
@@ -30,80 +36,176 @@ class PRResult:
     new_pr_url: str
 
 # Configure logger
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+_HEADERS = {
+    "Authorization": f"Bearer {GITHUB_TOKEN}",
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+    "User-Agent": "devflow-hands",
+    "Content-Type": "application/json"
+}
+
 def github_headers() -> Dict[str, str]:
-    """Standard GitHub API headers."""
-    return {
-        "Authorization": f"Bearer {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github+json",
-        "X-GitHub-Api-Version": "2022-11-28",
-        "User-Agent": "devflow-hands",
-        "Content-Type": "application/json"
-    }
+    """Standard GitHub API headers (built once at import)."""
+    return _HEADERS
 
 def verify_webhook_signature(payload: bytes, signature: str) -> bool:
     """Verify GitHub webhook signature."""
-    if not GITHUB_WEBHOOK_SECRET:
+    if not _SECRET_BYTES:
         return True
-    mac = hmac.new(GITHUB_WEBHOOK_SECRET.encode(), payload, hashlib.sha256)
+    mac = hmac.new(_SECRET_BYTES, payload, hashlib.sha256)
     expected = "sha256=" + mac.hexdigest()
     return hmac.compare_digest(expected, signature)
 
-def generate_readme_from_diff(repo_full: str, pr_number: int, diff: list) -> str:
+async def generate_readme_from_diff(repo_full: str, pr_number: int, diff: list) -> str:
     """Delegate to local orchestrator which runs vector search + ghost writer."""
     logger.info("Calling local orchestrator for README generation")
-    return orchestrator_generate_readme(repo_full, pr_number, diff)
+    return await orchestrator_generate_readme(repo_full, pr_number, diff)
 
 # === GITHUB FUNCTIONS (KEEP THESE) ===
-def get_repo_default_branch(repo_full: str) -> str:
+GH_MAX_RETRIES = 3
+
+async def gh_request(app: FastAPI, method: str, url: str,
+                     idempotent: Optional[bool] = None, **kwargs) -> httpx.Response:
+    """Send a GitHub API request, honouring rate-limit headers and retrying 429/5xx.
+
+    Concurrency across the process is bounded by `app.state.gh_sem`. A response
+    that exhausts the quota records its reset time in `app.state.gh_reset_at`;
+    that response is still returned, and the *next* request waits for the reset
+    (without holding the semaphore).
+
+    Rate-limit rejections (403/429) are always safe to retry: GitHub didn't act
+    on the request. A 5xx may come after the change was made, so it is only
+    retried when `idempotent` - which defaults to True for every method but
+    POST; pass it explicitly for POSTs that are safe to repeat.
+    """
+    if idempotent is None:
+        idempotent = method != "POST"
+    delay = 1.0
+    for attempt in range(GH_MAX_RETRIES + 1):
+        wait = app.state.gh_reset_at - time.time()
+        if wait > 0:
+            logger.warning("GitHub rate limit exhausted; sleeping %.0fs until reset", wait)
+            await asyncio.sleep(wait)
+
+        async with app.state.gh_sem:
+            resp = await app.state.http.request(method, url, **kwargs)
+
+        if resp.headers.get("x-ratelimit-remaining") == "0":
+            app.state.gh_reset_at = int(resp.headers.get("x-ratelimit-reset", "0")) + 1
+            if resp.status_code in (403, 429) and attempt < GH_MAX_RETRIES:
+                continue
+            return resp
+
+        retry_after = resp.headers.get("retry-after")
+        if resp.status_code in (403, 429) and retry_after and attempt < GH_MAX_RETRIES:
+            wait = max(int(retry_after), delay)
+        elif (resp.status_code == 429 or (resp.status_code >= 500 and idempotent)) and attempt < GH_MAX_RETRIES:
+            wait = delay
+        else:
+            return resp
+
+        logger.warning("GitHub %s %s returned %s; retrying in %.0fs (attempt %d/%d)",
+                       method, url, resp.status_code, wait, attempt + 1, GH_MAX_RETRIES)
+        await asyncio.sleep(wait)
+        delay *= 2
+    return resp
+
+# repo_full -> (fetched_at, default_branch); default branches almost never change
+DEFAULT_BRANCH_TTL = 3600
+_default_branch_cache: Dict[str, Tuple[float, str]] = {}
+
+async def get_repo_default_branch(app: FastAPI, repo_full: str) -> str:
+    cached = _default_branch_cache.get(repo_full)
+    if cached and time.monotonic() - cached[0] < DEFAULT_BRANCH_TTL:
+        return cached[1]
     url = f"{GITHUB_API_BASE}/repos/{repo_full}"
-    resp = requests.get(url, headers=github_headers(), timeout=30)
+    resp = await gh_request(app, "GET", url)
     resp.raise_for_status()
-    return resp.json()["default_branch"]
+    branch = resp.json()["default_branch"]
+    _default_branch_cache[repo_full] = (time.monotonic(), branch)
+    return branch
 
-def get_file_sha(repo_full: str, branch: str, path: str) -> Optional[str]:
-    url = f"{GITHUB_API_BASE}/repos/{repo_full}/contents/{path}?ref={branch}"
-    resp = requests.get(url, headers=github_headers(), timeout=30)
-    if resp.status_code == 404:
-        return None
+async def get_branch_head(app: FastAPI, repo_full: str, branch: str) -> str:
+    url = f"{GITHUB_API_BASE}/repos/{repo_full}/git/ref/heads/{branch}"
+    resp = await gh_request(app, "GET", url)
+    resp.raise_for_status()
+    return resp.json()["object"]["sha"]
+
+async def get_commit_tree(app: FastAPI, repo_full: str, commit_sha: str) -> str:
+    url = f"{GITHUB_API_BASE}/repos/{repo_full}/git/commits/{commit_sha}"
+    resp = await gh_request(app, "GET", url)
+    resp.raise_for_status()
+    return resp.json()["tree"]["sha"]
+
+async def create_blob(app: FastAPI, repo_full: str, content: str) -> str:
+    url = f"{GITHUB_API_BASE}/repos/{repo_full}/git/blobs"
+    # The blobs endpoint accepts text as-is, so skip the base64 round trip
+    payload = {"content": content, "encoding": "utf-8"}
+    # Blobs are content-addressed, so a repeated POST yields the same object
+    resp = await gh_request(app, "POST", url, idempotent=True, json=payload)
     resp.raise_for_status()
     return resp.json()["sha"]
 
-def create_or_update_file(repo_full: str, path: str, content: str, branch: str,
-                         message: str, sha: Optional[str] = None) -> Dict[str, Any]:
-    url = f"{GITHUB_API_BASE}/repos/{repo_full}/contents/{path}"
-    payload = {
+async def commit_files(app: FastAPI, repo_full: str, branch: str,
+                       files: Dict[str, str], message: str) -> Dict[str, Any]:
+    """Write every file in `files` to `branch` as one commit via the Git Data API.
+
+    Blobs are created concurrently, then a single tree, commit and ref update
+    follow: N+5 requests (head, base tree, N blobs, tree, commit, ref) instead of
+    two Contents API calls per file.
+    """
+    head_sha = await get_branch_head(app, repo_full, branch)
+    paths = list(files)
+    base_tree, *blob_shas = await asyncio.gather(
+        get_commit_tree(app, repo_full, head_sha),
+        *[create_blob(app, repo_full, files[path]) for path in paths]
+    )
+
+    tree_url = f"{GITHUB_API_BASE}/repos/{repo_full}/git/trees"
+    tree_payload = {
+        "base_tree": base_tree,
+        "tree": [
+            {"path": path, "mode": "100644", "type": "blob", "sha": sha}
+            for path, sha in zip(paths, blob_shas)
+        ]
+    }
+    # Repeating a tree/commit POST at worst leaves an unreferenced object; the
+    # ref only moves in the PATCH below
+    tree_resp = await gh_request(app, "POST", tree_url, idempotent=True, json=tree_payload)
+    tree_resp.raise_for_status()
+
+    commit_url = f"{GITHUB_API_BASE}/repos/{repo_full}/git/commits"
+    commit_payload = {
         "message": message,
-        "content": base64.b64encode(content.encode("utf-8")).decode("utf-8"),
-        "branch": branch
+        "tree": tree_resp.json()["sha"],
+        "parents": [head_sha]
     }
-    if sha:
-        payload["sha"] = sha
-    resp = requests.put(url, headers=github_headers(), json=payload, timeout=30)
+    commit_resp = await gh_request(app, "POST", commit_url, idempotent=True, json=commit_payload)
+    commit_resp.raise_for_status()
+    commit = commit_resp.json()
+
+    ref_url = f"{GITHUB_API_BASE}/repos/{repo_full}/git/refs/heads/{branch}"
+    resp = await gh_request(app, "PATCH", ref_url, json={"sha": commit["sha"]})
     resp.raise_for_status()
-    return resp.json()
+    return commit
 
-def create_branch(repo_full: str, new_branch: str, default_branch: str) -> None:
-    ref_url = f"{GITHUB_API_BASE}/repos/{repo_full}/git/ref/heads/{default_branch}"
-    ref_resp = requests.get(ref_url, headers=github_headers(), timeout=30)
-    ref_resp.raise_for_status()
-    default_sha = ref_resp.json()["object"]["sha"]
+async def create_branch(app: FastAPI, repo_full: str, new_branch: str, default_branch: str) -> None:
+    default_sha = await get_branch_head(app, repo_full, default_branch)
     
     create_url = f"{GITHUB_API_BASE}/repos/{repo_full}/git/refs"
     payload = {"ref": f"refs/heads/{new_branch}", "sha": default_sha}
-    resp = requests.post(create_url, headers=github_headers(), json=payload, timeout=30)
+    # A retry after the ref was created gets 422, handled as "already exists"
+    resp = await gh_request(app, "POST", create_url, idempotent=True, json=payload)
     if resp.status_code == 422:
         logger.info("Branch %s already exists, continuing...", new_branch)
     else:
         resp.raise_for_status()
 
-def create_pull_request(repo_full: str, head_branch: str, base_branch: str,
-                       pr_number: int, title: str, body: str) -> Dict[str, Any]:
+async def create_pull_request(app: FastAPI, repo_full: str, head_branch: str, base_branch: str,
+                              pr_number: int, title: str, body: str) -> Dict[str, Any]:
     url = f"{GITHUB_API_BASE}/repos/{repo_full}/pulls"
     payload = {
         "title": title,
@@ -111,11 +213,11 @@ def create_pull_request(repo_full: str, head_branch: str, base_branch: str,
         "base": base_branch,
         "body": body
     }
-    resp = requests.post(url, headers=github_headers(), json=payload, timeout=30)
+    resp = await gh_request(app, "POST", url, json=payload)
     resp.raise_for_status()
     return resp.json()
 
-def process_merged_pr(repo_full: str, pr_number: int, diff: list) -> PRResult:
+async def process_merged_pr(app: FastAPI, repo_full: str, pr_number: int, diff: list) -> PRResult:
     """
     SIMPLIFIED FLOW:
     Person 4 → You → Person 2 → GitHub PR
@@ -125,32 +227,29 @@ def process_merged_pr(repo_full: str, pr_number: int, diff: list) -> PRResult:
     logger.info("🤖 Processing PR #%s in %s", pr_number, repo_full)
     
     # 1. Call orchestrator to get per-file updates (mapping: path -> new content)
-    updates = generate_readme_from_diff(repo_full, pr_number, diff)
+    updates = await generate_readme_from_diff(repo_full, pr_number, diff)
 
     # 2. GitHub mechanics: create branch, write each updated file
-    default_branch = get_repo_default_branch(repo_full)
+    default_branch = await get_repo_default_branch(app, repo_full)
     feature_branch = f"devflow/readme-pr-{pr_number}"
 
     logger.info("🌿 Creating branch %s from %s", feature_branch, default_branch)
-    create_branch(repo_full, feature_branch, default_branch)
+    await create_branch(app, repo_full, feature_branch, default_branch)
 
     if not updates:
         logger.warning("⚠️ Orchestrator produced no updates; nothing to commit.")
         return PRResult("no_changes", 0, "")
 
-    files_written = []
-    for path, new_content in updates.items():
-        logger.info("✏️ Updating %s...", path)
-        existing_sha = get_file_sha(repo_full, feature_branch, path)
-        create_or_update_file(
-            repo_full, path, new_content, feature_branch,
-            f"docs(readme): auto-update from PR #{pr_number}", existing_sha
-        )
-        files_written.append(path)
+    files_written = list(updates)
+    logger.info("✏️ Committing %d file(s): %s", len(files_written), ", ".join(files_written))
+    await commit_files(
+        app, repo_full, feature_branch, updates,
+        f"docs(readme): auto-update from PR #{pr_number}"
+    )
 
     logger.info("🚀 Creating PR with updated docs...")
-    pr = create_pull_request(
-        repo_full, feature_branch, default_branch, pr_number,
+    pr = await create_pull_request(
+        app, repo_full, feature_branch, default_branch, pr_number,
         f"docs(readme): auto-update for PR #{pr_number}",
         f"Auto-generated documentation updates from PR #{pr_number}\n\nFiles updated ({len(files_written)}):\n" + "\n".join(files_written)
     )
@@ -158,15 +257,58 @@ def process_merged_pr(repo_full: str, pr_number: int, diff: list) -> PRResult:
     logger.info("✅ Success! New PR: %s", pr['html_url'])
     return PRResult("success", pr["number"], pr['html_url'])
 
-app = FastAPI()
+async def handle_merged_pr(app: FastAPI, repo_full: str, pr_number: int) -> None:
+    """Background job: fetch the PR's changed files and run the README update flow."""
+    try:
+        # get_pr_files uses the blocking requests session (and its own page thread
+        # pool); run it in a worker thread so the event loop keeps serving webhooks
+        changed_files = await asyncio.to_thread(get_pr_files, repo_full, pr_number)
+        logger.info("Captured changes for %d files.", len(changed_files))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Changed files: %s", [f["filename"] for f in changed_files])
+        
+        await process_merged_pr(app, repo_full, pr_number, changed_files)
+    except Exception:
+        logger.exception("Background processing failed for PR #%s in %s", pr_number, repo_full)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled client per process, shared by every GitHub helper
+    app.state.http = httpx.AsyncClient(
+        headers=github_headers(),
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50)
+    )
+    app.state.gh_sem = asyncio.Semaphore(10)
+    app.state.gh_reset_at = 0.0
+    # Build the readme_chunks index now rather than on the first webhook; run in
+    # the background so an unreachable Mongo doesn't hold up startup
+    index_task = asyncio.create_task(ensure_chunk_index_async(get_motor_db()["readme_chunks"]))
+    yield
+    index_task.cancel()
+    await app.state.http.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
 async def root():
     return {"message": "GitHub PR Webhook API is running", "webhook_endpoint": "/webhook"}
 
 @app.post("/webhook")
-async def github_webhook(request: Request):
-    payload = await request.json()
+async def github_webhook(request: Request, background_tasks: BackgroundTasks):
+    # 0. FAST PATH: GitHub names the event in a header, so non-PR deliveries
+    # (push, ping, check_run, ...) are dropped without reading the body. Only
+    # subscribing the webhook to "Pull requests" avoids these deliveries entirely.
+    if request.headers.get("X-GitHub-Event") != "pull_request":
+        return {"msg": "Ignored: Not a PR event"}
+
+    # Read the raw body once: HMAC is computed over these bytes and the same
+    # buffer is parsed, instead of letting Starlette decode it a second time.
+    body = await request.body()
+    signature = request.headers.get("X-Hub-Signature-256", "")
+    if not verify_webhook_signature(body, signature):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    payload = orjson.loads(body)
     
     # 1. FILTER: We only care about Pull Requests
     if "pull_request" not in payload:
@@ -178,23 +320,32 @@ async def github_webhook(request: Request):
     
     # 2. GUARD: Only proceed if the PR was actually merged
     if action == "closed" and merged:
-        logger.info(f"🚀 Merge Detected: PR #{pr['number']} - {pr['title']}")
+        logger.info("🚀 Merge Detected: PR #%s - %s", pr['number'], pr['title'])
         
         # 3. EXTRACTION: Get the repo details
         repo_full_name = payload["repository"]["full_name"] # e.g. "octocat/hello-world"
         pr_number = pr["number"]
         
-        # 4. ACTION: Fetch the changed files (Your logic)
-        changed_files = get_pr_files(repo_full_name, pr_number)
-        logger.info(f"Captured changes for {len(changed_files)} files.")
-        logger.info(f"Changed files: {changed_files}")
-        
-        process_merged_pr(repo_full_name, pr_number, changed_files)
+        # 4. ACTION: Hand off to a background task so GitHub gets its response
+        # well inside the 10s delivery timeout
+        background_tasks.add_task(handle_merged_pr, request.app, repo_full_name, pr_number)
         
-        return {
-            "status": "success", 
-            "event": "merged", 
-            "files_processed": len(changed_files)
-        }
+        return JSONResponse(
+            status_code=202,
+            content={"status": "accepted", "event": "merged", "pr_number": pr_number}
+        )
         
-    return {"msg": "Ignored: PR not merged"}
\ No newline at end of file
+    return {"msg": "Ignored: PR not merged"}
+
+
+if __name__ == "__main__":
+    # Local/container entrypoint. uvloop + httptools are uvicorn's fast loop and
+    # HTTP parser (installed via uvicorn[standard]); uvloop has no Windows build.
+    uvicorn.run(
+        "api.index:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        loop="uvloop" if sys.platform != "win32" else "asyncio",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
@@ -0,0 +1,13 @@
+import logging
+
+
+def configure_logging(level: int = logging.INFO) -> None:
+    """Configure root logging once for the whole process.
+
+    Library modules only call `logging.getLogger(__name__)`; the entrypoint
+    (`api.index`) is the single place that installs handlers.
+    """
+    logging.basicConfig(
+        level=level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
@@ -1,135 +1,133 @@
 import os
+import hashlib
 import logging
-import warnings
-from fireworks.client import Fireworks
+import pathlib
+from collections import OrderedDict
+from typing import Optional, Set
 
-# Suppress aiohttp unclosed session warnings
-warnings.filterwarnings("ignore", message=".*Unclosed client session.*")
+import httpx
+from fireworks import AsyncFireworks
 
-def read_file(filepath):
-    with open(filepath, 'r') as file:
-        return file.read()
+logger = logging.getLogger(__name__)
 
-def draft_readme_update(diff, current_chunk):
-    # Configure logger (follow pattern used in `api/index.py`)
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
-    logger = logging.getLogger(__name__)
-
-    SYSTEM_PROMPT = """
-    ### SYSTEM PROMPT: DOCUMENTATION NAVIGATOR
-You are a Surgical Documentation Agent. Your goal is to update the README based on a code DIFF and a DEPENDENCY MAP.
-
-### CONTEXT:
-1. **CODE DIFF**: [The technical changes]
-2. **DEPENDENCY MAP (from MongoDB)**: 
-   $dependency_chunks
-   (This tells you exactly which README sections are impacted by the files in the diff.)
-
-### YOUR TASK:
-1. **Identify Targets**: Based on the DEPENDENCY MAP, list the specific README sections that need modification.
-2. **Surgical Edit**: Update ONLY those sections. 
-3. **Consistency Check**: Ensure the new technical details from the DIFF are integrated into the sections identified by the MAP.
-
-### CONSTRAINTS:
-- **Do Not Drift**: If the MAP says only the "API" section is impacted, do not touch the "Usage" section even if you think you should. Trust the MAP.
-- **Maintain Flow**: Even though the update is surgical, ensure the transition between the old text and the new update is seamless.
-
-RULES:
-KEEP these sections if they exist and are unchanged:
-✓ Badges (stars, license, CI status)
-✓ Project title + description
-✓ Table of contents
-✓ License footer
-
-UPDATE these in the readme.md based on changes:
-- Features list
-- Installation (new deps)
-- Quickstart/Usage
-- API endpoints
-- Screenshots/GIFs (describe)
-
-ADD these if missing:
-- New feature sections
-- New commands
-- Environment variables
-
- OUTPUT FORMAT (MUST be valid Markdown):
-```markdown
- [Project Name]
-[![Stars][stars]][repo] [![License][license]][license]
-> [1-sentence project description - update if scope changed]
-
-Features
-- [Updated list with new features from PR]
-
-Installation
-```bash
-[Updated install commands with new deps]
-
-Quick Start
-bash
-npm run dev   or whatever the new start command is
-
-API / Usage
-text
-| Endpoint | Method | Description |
-|----------|--------|-------------|
-| `/auth`  | POST   | JWT login   |  [NEW from PR]
-Contributing
-[Keep existing or standard template]
-License
-[Keep existing]
-
- CONSTRAINTS:
-•	REPLACE entire README (don't say "update section X")
-•	Use exactly the same badges/TOC structure from old_readme
-•	Keep tone and style consistent with old_readme
-•	NEVER delete screenshots/badges/license
-•	DO NOT DELETE any sections unless explicitly told by the DIFF
-•	If no changes needed, return the original README exactly
-•	Be concise; avoid fluff
-•	Use markdown code blocks for commands/tables
-•	Use the same section headings as the original README
-•	When adding new sections, follow the existing README style
-•	Always include working code blocks (no placeholders)
-•	Max 2000 lines (concise but complete)
-•	No "I updated..." commentary
-•	No breaking existing sections unnecessarily
+PROMPT_PATH = pathlib.Path(__file__).resolve().parent.parent / "prompts" / "ghost_writer_prompt.txt"
+
+# Loaded once at import; the prompt is static for the life of the process. It is
+# always sent as the leading system message with every variable input in the
+# final user turn, so each call shares an identical prefix that Fireworks'
+# prompt cache can reuse.
+SYSTEM_PROMPT = PROMPT_PATH.read_text(encoding="utf-8")
+
+# Pins requests that share SYSTEM_PROMPT to the same replica, where its
+# cached prefix lives
+_PREFIX_AFFINITY = hashlib.blake2b(SYSTEM_PROMPT.encode("utf-8"), digest_size=8).hexdigest()
+
+# Every candidate is triaged on the fast 8B model; only files it doesn't clear
+# get the (single) full rewrite on the 70B model
+TRIAGE_MODEL = "accounts/fireworks/models/llama-v3p1-8b-instruct"
+DRAFT_MODEL = "accounts/fireworks/models/llama-v3p3-70b-instruct"
+
+# Triage replies with NO_CHANGE_MARKER or "UPDATE"; only an explicit marker
+# skips the rewrite, so an unclear reply never vetoes an update
+NO_CHANGE_MARKER = "NO_CHANGE"
+TRIAGE_INSTRUCTION = (
+    "Do NOT rewrite the file. Reply with exactly one word: "
+    f"{NO_CHANGE_MARKER} if the DIFF requires no change to CURRENT SECTION, otherwise UPDATE."
+)
+TRIAGE_MAX_TOKENS = 4
+
+_client: Optional[AsyncFireworks] = None
+
+# Models Fireworks answered 404 for. A wrong or retired model id fails the same
+# way for every candidate file, so later calls fail fast instead of re-asking.
+_unavailable_models: Set[str] = set()
+
+# In-process LRU of drafts keyed by a hash of (model, prompt, diff, chunk), so
+# redelivered webhooks and repeated diff/file pairs skip the LLM call.
+DRAFT_CACHE_SIZE = 256
+_draft_cache: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _get_client() -> AsyncFireworks:
+    """Return the shared Fireworks client, creating it on first use.
+
+    Built lazily so `FIREWORKS_API_KEY` is read after the caller has loaded `.env`.
     """
-    logger.debug("SYSTEM PROMPT: %s", SYSTEM_PROMPT)
+    global _client
+    if _client is None:
+        # One pooled HTTP client per process keeps TLS connections warm across drafts
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            timeout=120
+        )
+        _client = AsyncFireworks(api_key=os.environ.get("FIREWORKS_API_KEY"), http_client=http_client)
+        logger.debug("SYSTEM PROMPT: %s", SYSTEM_PROMPT)
+    return _client
+
+
+def _is_model_not_found(e: Exception) -> bool:
+    return getattr(e, "status_code", None) == 404 or "NOT_FOUND" in str(e)
+
+
+def _draft_cache_key(model: str, user_content: str, max_tokens: Optional[int] = None) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in (model, str(max_tokens), SYSTEM_PROMPT, user_content):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+async def _complete(model: str, user_content: str, max_tokens: Optional[int] = None) -> str:
+    """Run SYSTEM_PROMPT + `user_content` on `model`, via the draft cache."""
+    key = _draft_cache_key(model, user_content, max_tokens)
+    cached = _draft_cache.get(key)
+    if cached is not None:
+        _draft_cache.move_to_end(key)
+        logger.info("Draft cache hit; skipping Fireworks call")
+        return cached
+    if model in _unavailable_models:
+        raise RuntimeError(f"Fireworks model {model} is unavailable (404 earlier in this process)")
 
-    # Create client
-    client = Fireworks(api_key=os.environ.get("FIREWORKS_API_KEY"))
     try:
-        response = client.chat.completions.create(
-            model="accounts/fireworks/models/llama-v3p3-70b-instruct",
+        extra = {"max_tokens": max_tokens} if max_tokens is not None else {}
+        response = await _get_client().chat.completions.create(
+            model=model,
             messages=[
                 {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"DIFF:\n{diff}\n\nCURRENT SECTION:\n{current_chunk}"}
+                {"role": "user", "content": user_content}
             ],
-            temperature=0.1
+            temperature=0.1,
+            extra_headers={"x-session-affinity": _PREFIX_AFFINITY},
+            **extra
         )
         result = response.choices[0].message.content
-        
-        # Attempt to close internal aiohttp session
-        try:
-            if hasattr(client, '_client') and hasattr(client._client, 'close'):
-                client._client.close()
-            elif hasattr(client, 'client') and hasattr(client.client, 'close'):
-                client.client.close()
-        except:
-            pass
-            
+        _draft_cache[key] = result
+        if len(_draft_cache) > DRAFT_CACHE_SIZE:
+            _draft_cache.popitem(last=False)
         return result
     except Exception as e:
-        logger.error(f"Fireworks API call failed: {e}")
-        # Still attempt cleanup
-        try:
-            if hasattr(client, '_client') and hasattr(client._client, 'close'):
-                client._client.close()
-        except:
-            pass
+        if _is_model_not_found(e):
+            _unavailable_models.add(model)
+            logger.error("Fireworks model %s not found; skipping it for the rest of this process", model)
+        else:
+            logger.error("Fireworks API call failed: %s", e)
         raise
+
+
+async def needs_readme_update(diff, current_chunk, model=TRIAGE_MODEL) -> bool:
+    """Ask the fast model whether `diff` calls for any change to `current_chunk`.
+
+    Only a reply starting with `NO_CHANGE_MARKER` returns False. The reply is
+    capped at a few tokens, so the call costs little more than prefill.
+    """
+    reply = await _complete(
+        model,
+        f"DIFF:\n{diff}\n\nCURRENT SECTION:\n{current_chunk}\n\n{TRIAGE_INSTRUCTION}",
+        max_tokens=TRIAGE_MAX_TOKENS
+    )
+    return not (reply or "").strip().upper().startswith(NO_CHANGE_MARKER)
+
+
+async def draft_readme_update(diff, current_chunk, model=DRAFT_MODEL):
+    """Return the updated file for `diff`, written by the large model."""
+    return await _complete(model, f"DIFF:\n{diff}\n\nCURRENT SECTION:\n{current_chunk}")
@@ -1,30 +1,92 @@
 import os
-from github import Github
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+GITHUB_API_BASE = "https://api.github.com"
+
+# Skip per-file patches bigger than this many changed lines, and stop collecting
+# patches once their combined size passes the byte budget (bounds LLM prompt size)
+MAX_FILE_CHANGES = 5000
+PATCH_BYTE_BUDGET = 512_000
+
+_SESSION: Optional[requests.Session] = None
+
+
+def get_session() -> requests.Session:
+    """Return the pooled GitHub session, creating it on first use.
+
+    Built lazily so `GITHUB_TOKEN` is read after the caller has loaded `.env`.
+    Ensure GITHUB_TOKEN is in your Vercel Environment Variables.
+    """
+    global _SESSION
+    if _SESSION is not None:
+        return _SESSION
+    session = requests.Session()
+    session.headers.update({"Accept": "application/vnd.github+json"})
+    token = os.environ.get("GITHUB_TOKEN")
+    if token:
+        session.headers["Authorization"] = f"Bearer {token}"
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=50, pool_maxsize=100, max_retries=retry))
+    _SESSION = session
+    return session
+
+
+def _get_files_page(url: str, page: int) -> List[Dict[str, Any]]:
+    resp = get_session().get(url, params={"per_page": 100, "page": page}, timeout=30)
+    resp.raise_for_status()
+    return resp.json()
 
-# Setup GitHub Client
-# Ensure GITHUB_TOKEN is in your Vercel Environment Variables
-g = Github(os.getenv("GITHUB_TOKEN"))
 
 def get_pr_files(repo_name, pr_number):
     """
     Returns a list of changed files with their raw diffs.
+
+    Page 1 of `/pulls/{n}/files` tells us the last page via its `Link` header;
+    the remaining pages are then fetched in parallel.
     """
-    repo = g.get_repo(repo_name)
-    pr = repo.get_pull(pr_number)
-    
+    url = f"{GITHUB_API_BASE}/repos/{repo_name}/pulls/{pr_number}/files"
+    resp = get_session().get(url, params={"per_page": 100, "page": 1}, timeout=30)
+    resp.raise_for_status()
+    pages = [resp.json()]
+
+    last_url = resp.links.get("last", {}).get("url")
+    last_page = int(parse_qs(urlparse(last_url).query)["page"][0]) if last_url else 1
+    if last_page > 1:
+        with ThreadPoolExecutor(max_workers=min(8, last_page - 1)) as ex:
+            pages.extend(ex.map(lambda p: _get_files_page(url, p), range(2, last_page + 1)))
+
     files_data = []
-    
+    patch_bytes = 0
+
     # Get all files in this PR
-    for file in pr.get_files():
+    for file in (f for page in pages for f in page):
         # Optimization: Skip assets, lockfiles, or images
-        if file.filename.endswith(('.png', '.jpg', '.lock', '.json')):
+        if file["filename"].endswith(('.png', '.jpg', '.lock', '.json')):
             continue
-            
+        # Binary files have no patch; huge ones would swamp the prompt
+        patch = file.get("patch")
+        if patch is None or file.get("changes", 0) > MAX_FILE_CHANGES:
+            continue
+
+        patch_bytes += len(patch)
+        if patch_bytes > PATCH_BYTE_BUDGET:
+            logger.warning("Patch budget of %d bytes reached; ignoring remaining files", PATCH_BYTE_BUDGET)
+            break
+
         files_data.append({
-            "filename": file.filename,
-            "status": file.status,      # 'added', 'modified', 'removed'
-            "patch": file.patch,        # THE GOLD: This is the actual diff text
-            "raw_url": file.raw_url     # Link to full file content if needed
+            "filename": file["filename"],
+            "status": file["status"],      # 'added', 'modified', 'removed'
+            "patch": patch,                # THE GOLD: This is the actual diff text
+            "raw_url": file["raw_url"]     # Link to full file content if needed
         })
-        
-    return files_data
\ No newline at end of file
+
+    return files_data
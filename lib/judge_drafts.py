@@ -1,14 +1,34 @@
 import os
 import logging
-from fireworks.client import Fireworks
+from typing import Optional
+
+import httpx
+from fireworks import Fireworks
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[Fireworks] = None
+
 
 def read_file(filepath):
     with open(filepath, 'r') as file:
         return file.read()
 
+
+def _get_client() -> Fireworks:
+    """Return the shared Fireworks client, creating it on first use."""
+    global _client
+    if _client is None:
+        # Explicit pool so judge calls reuse warm TLS connections
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60),
+            timeout=30.0
+        )
+        _client = Fireworks(api_key=os.environ.get("FIREWORKS_API_KEY"), http_client=http_client)
+    return _client
+
+
 def judge_verify_update(diff, draft):
-    client = Fireworks(api_key=os.environ.get("FIREWORKS_API_KEY"))
-    
     # Prompt the 8B model to be highly critical
     JUDGE_PROMPT = f"""
     Review this documentation update against the code diff. 
@@ -21,13 +41,24 @@ def judge_verify_update(diff, draft):
     Return ONLY: PASS or FAIL: [Reason]
     """
 
-    response = client.chat.completions.create(
+    # Stream the verdict: a PASS is decided by the first token, so stop the
+    # generation there. FAIL keeps streaming so the reason is captured.
+    stream = _get_client().chat.completions.create(
         model="accounts/fireworks/models/llama-v3p1-8b-instruct",
-        messages=[{"role": "user", "content": JUDGE_PROMPT}]
+        messages=[{"role": "user", "content": JUDGE_PROMPT}],
+        stream=True
     )
     
-    verdict = response.choices[0].message.content
-    # Ensure logger exists (in case this function is used standalone)
-    logger = logging.getLogger(__name__)
+    verdict = ""
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                verdict += chunk.choices[0].delta.content
+            if verdict.lstrip().startswith("PASS"):
+                break
+    finally:
+        stream.close()
+
+    verdict = verdict.strip()
     logger.info("JUDGE VERDICT: %s", verdict)
-    return verdict.startswith("PASS"), verdict
\ No newline at end of file
+    return verdict.startswith("PASS"), verdict
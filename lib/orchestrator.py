@@ -1,22 +1,52 @@
-import os
 import logging
 import base64
-from typing import List, Dict, Any
-import requests
+import asyncio
+import io
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 
 from . import vector_search
 from . import ghost_writer
+from .github_utils import get_session
 
 logger = logging.getLogger(__name__)
 
+# Max concurrent Fireworks draft calls per PR
+DRAFT_CONCURRENCY = 6
+
+# Per-file patch cap in the combined diff, bounding embedding and LLM prompt size
+MAX_PATCH_CHARS = 8192
+
+# Files fetched per GitHub GraphQL request
+GRAPHQL_BATCH_SIZE = 50
+
+# Decoded file text keyed by git blob SHA; content-addressed, so never stale
+BLOB_CACHE_SIZE = 256
+_blob_cache: "OrderedDict[str, str]" = OrderedDict()
+# _get_files_from_github runs in worker threads (asyncio.to_thread)
+_blob_cache_lock = threading.Lock()
+
+# repo_full -> (head commit sha, result of `_get_tree_shas`)
+_tree_cache: Dict[str, Tuple[str, Tuple[Dict[str, str], bool]]] = {}
+
 
 def _build_combined_diff(diff: List[Dict[str, Any]]) -> str:
-    parts = []
-    for f in diff:
-        filename = f.get("filename", "unknown")
+    """Concatenate per-file patches in one pass, truncating each to `MAX_PATCH_CHARS`."""
+    buf = io.StringIO()
+    for i, f in enumerate(diff):
         patch = f.get("patch") or ""
-        parts.append(f"FILE: {filename}\nPATCH:\n{patch}\n---\n")
-    return "\n".join(parts)
+        if len(patch) > MAX_PATCH_CHARS:
+            patch = f"{patch[:MAX_PATCH_CHARS]}\n... [truncated {len(patch) - MAX_PATCH_CHARS} chars]"
+        if i:
+            buf.write("\n")
+        buf.write("FILE: ")
+        buf.write(f.get("filename", "unknown"))
+        buf.write("\nPATCH:\n")
+        buf.write(patch)
+        buf.write("\n---\n")
+    return buf.getvalue()
 
 
 def _get_readme_from_github(repo_full: str) -> str:
@@ -24,13 +54,8 @@ def _get_readme_from_github(repo_full: str) -> str:
 
     Returns the decoded markdown string, or an empty string if not found.
     """
-    token = os.environ.get("GITHUB_TOKEN")
-    headers = {"Accept": "application/vnd.github+json"}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-
     url = f"https://api.github.com/repos/{repo_full}/readme"
-    resp = requests.get(url, headers=headers, timeout=30)
+    resp = get_session().get(url, timeout=30)
     if resp.status_code == 404:
         logger.info("README.md not found for %s", repo_full)
         return ""
@@ -50,13 +75,8 @@ def _get_readme_from_github(repo_full: str) -> str:
 
 def _get_file_from_github(repo_full: str, path: str) -> str:
     """Fetch an arbitrary file's content from the repo (decoded). Returns empty string on error."""
-    token = os.environ.get("GITHUB_TOKEN")
-    headers = {"Accept": "application/vnd.github+json"}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-
     url = f"https://api.github.com/repos/{repo_full}/contents/{path}"
-    resp = requests.get(url, headers=headers, timeout=30)
+    resp = get_session().get(url, timeout=30)
     if resp.status_code == 404:
         logger.info("File not found: %s in %s", path, repo_full)
         return ""
@@ -73,14 +93,171 @@ def _get_file_from_github(repo_full: str, path: str) -> str:
         return ""
 
 
-def generate_readme_from_diff(repo_full: str, pr_number: int, diff: List[Dict[str, Any]]) -> str:
+def _get_head_sha(repo_full: str) -> Optional[str]:
+    """Return the default branch's head commit SHA (a ~40-byte response), or None on error."""
+    url = f"https://api.github.com/repos/{repo_full}/commits/HEAD"
+    try:
+        resp = get_session().get(url, headers={"Accept": "application/vnd.github.sha"}, timeout=30)
+        resp.raise_for_status()
+    except Exception:
+        logger.exception("Failed to resolve HEAD for %s", repo_full)
+        return None
+    return resp.text.strip()
+
+
+def _get_tree_shas(repo_full: str) -> Optional[Tuple[Dict[str, str], bool]]:
+    """Return `({path: blob_sha}, truncated)` for the default branch, or None on error.
+
+    The recursive listing is cached per repo and reused until the head commit
+    moves, so repeat PRs against an unchanged branch cost one tiny request.
+    """
+    head_sha = _get_head_sha(repo_full)
+    if head_sha is None:
+        return None
+    cached = _tree_cache.get(repo_full)
+    if cached is not None and cached[0] == head_sha:
+        return cached[1]
+
+    url = f"https://api.github.com/repos/{repo_full}/git/trees/{head_sha}"
+    try:
+        resp = get_session().get(url, params={"recursive": "1"}, timeout=30)
+        resp.raise_for_status()
+        data = resp.json()
+    except Exception:
+        logger.exception("Failed to list tree for %s", repo_full)
+        return None
+    shas = {e["path"]: e["sha"] for e in data.get("tree", []) if e.get("type") == "blob"}
+    tree = (shas, bool(data.get("truncated")))
+    _tree_cache[repo_full] = (head_sha, tree)
+    return tree
+
+
+def _blob_cache_get(sha: str) -> Optional[str]:
+    with _blob_cache_lock:
+        text = _blob_cache.get(sha)
+        if text is not None:
+            _blob_cache.move_to_end(sha)
+        return text
+
+
+def _blob_cache_put(sha: str, text: str) -> None:
+    with _blob_cache_lock:
+        _blob_cache[sha] = text
+        _blob_cache.move_to_end(sha)
+        if len(_blob_cache) > BLOB_CACHE_SIZE:
+            _blob_cache.popitem(last=False)
+
+
+def _get_files_from_github(repo_full: str, paths: List[str]) -> Dict[str, str]:
+    """Fetch several files from the default branch with as few requests as possible.
+
+    One recursive tree listing (cached per head commit) maps each path to its
+    blob SHA. Blobs already seen are served from an in-process cache (a blob SHA
+    always names the same content); paths absent from a complete tree are
+    missing and map to an empty string. The rest are read up to
+    `GRAPHQL_BATCH_SIZE` per GraphQL request as aliased `object(...)` blob
+    nodes - by oid when the tree knew the path, else by `HEAD:<path>`. Files
+    GraphQL can't return as text (binary or truncated), and whole batches whose
+    GraphQL call fails (e.g. no token), fall back to `_get_file_from_github`.
+    """
+    contents: Dict[str, str] = {}
+    if not paths:
+        return contents
+    tree = _get_tree_shas(repo_full)
+
+    # (path, GraphQL type, selector value, blob sha or None)
+    pending: List[Tuple[str, str, str, Optional[str]]] = []
+    for path in paths:
+        sha = tree[0].get(path) if tree else None
+        if sha is not None:
+            cached = _blob_cache_get(sha)
+            if cached is not None:
+                contents[path] = cached
+            else:
+                pending.append((path, "GitObjectID", sha, sha))
+        elif tree is not None and not tree[1]:
+            logger.info("File not found: %s in %s", path, repo_full)
+            contents[path] = ""
+        else:
+            pending.append((path, "String", f"HEAD:{path}", None))
+
+    owner, name = repo_full.split("/", 1)
+    for start in range(0, len(pending), GRAPHQL_BATCH_SIZE):
+        batch = pending[start:start + GRAPHQL_BATCH_SIZE]
+        params = ", ".join(f"$s{i}: {gql_type}!" for i, (_, gql_type, _, _) in enumerate(batch))
+        fields = " ".join(
+            f"f{i}: object({'oid' if gql_type == 'GitObjectID' else 'expression'}: $s{i}) "
+            f"{{ ... on Blob {{ text isTruncated }} }}"
+            for i, (_, gql_type, _, _) in enumerate(batch)
+        )
+        query = (f"query($owner: String!, $name: String!, {params}) "
+                 f"{{ repository(owner: $owner, name: $name) {{ {fields} }} }}")
+        variables = {"owner": owner, "name": name}
+        variables.update({f"s{i}": value for i, (_, _, value, _) in enumerate(batch)})
+
+        try:
+            resp = get_session().post("https://api.github.com/graphql",
+                                       json={"query": query, "variables": variables}, timeout=30)
+            resp.raise_for_status()
+            repo = (resp.json().get("data") or {}).get("repository")
+            if repo is None:
+                raise ValueError(f"GraphQL returned no repository: {resp.text[:200]}")
+        except Exception:
+            logger.exception("GraphQL file fetch failed for %s; falling back to REST", repo_full)
+            for path, _, _, _ in batch:
+                contents[path] = _get_file_from_github(repo_full, path)
+            continue
+
+        for i, (path, _, _, sha) in enumerate(batch):
+            blob = repo.get(f"f{i}")
+            if blob is None:
+                logger.info("File not found: %s in %s", path, repo_full)
+                contents[path] = ""
+            elif blob.get("text") is None or blob.get("isTruncated"):
+                contents[path] = _get_file_from_github(repo_full, path)
+            else:
+                contents[path] = blob["text"]
+                if sha is not None:
+                    _blob_cache_put(sha, blob["text"])
+    return contents
+
+
+# An optional ```lang opening line and closing ``` around the whole reply
+_FENCE_RE = re.compile(r"\A```[\w-]*[ \t]*\n(.*?)\n?```\Z", re.DOTALL)
+
+
+def _unfence(text: str) -> str:
+    """Strip the markdown fence the prompt's OUTPUT FORMAT asks the model to wrap replies in."""
+    text = text.strip()
+    m = _FENCE_RE.match(text)
+    return m.group(1).strip() if m else text
+
+
+def _changed(new: Optional[str], current: str) -> bool:
+    return bool(new) and _unfence(new) != _unfence(current)
+
+
+async def _triage_and_draft(diff_text: str, current_content: str) -> Optional[str]:
+    """Return the updated file, or None if no change is needed.
+
+    The 8B model first triages the candidate with a few-token reply; files it
+    marks as unaffected stop there. The rest get one 70B rewrite with the same
+    prompt as a plain draft.
+    """
+    if not await ghost_writer.needs_readme_update(diff_text, current_content):
+        return None
+    new_content = await ghost_writer.draft_readme_update(diff_text, current_content)
+    return new_content if _changed(new_content, current_content) else None
+
+
+async def generate_readme_from_diff(repo_full: str, pr_number: int, diff: List[Dict[str, Any]]) -> str:
     """Orchestrator: run vector search, call ghost_writer to draft README, return new README markdown.
 
     Steps:
     - Build a combined diff text from changed files
-    - Run `vector_search.find_relevant_docs` to log the files that look relevant
+    - Run `vector_search.find_relevant_docs_async` to log the files that look relevant
     - Fetch the current `README.md` from GitHub
-    - Call `ghost_writer.draft_readme_update(diff_text, current_readme)` to get updated README
+    - Triage each candidate with the fast model, then rewrite the affected ones with the large model
     - Return the updated README markdown
     """
     logger.info("Orchestrator: generating README for %s PR#%s", repo_full, pr_number)
@@ -90,34 +267,54 @@ def generate_readme_from_diff(repo_full: str, pr_number: int, diff: List[Dict[st
     repo_name = repo_full.split("/")[-1]
     file_updates = {}
 
-    logger.info(f"Using repo_name for vector search: {repo_name}")
+    logger.info("Using repo_name for vector search: %s", repo_name)
     try:
-        hits = vector_search.find_relevant_docs(diff_text, "blastradius-demo", top_k=12)
+        hits = await vector_search.find_relevant_docs_async(diff_text, "blastradius-demo", top_k=12)
         logger.info("Vector search top hits: %s", hits[:12])
     except Exception:
         logger.exception("Vector search failed; no files to update")
         hits = []
 
-    # Each hit is (file_path, score). For each file, fetch current contents and call ghost_writer.
+    # Each hit is (file_path, score). Fetch every candidate in one batched call,
+    # then draft them concurrently; the semaphore keeps us under Fireworks rate limits.
+    contents = await asyncio.to_thread(_get_files_from_github, repo_full, [fp for fp, _ in hits])
+    sem = asyncio.Semaphore(DRAFT_CONCURRENCY)
+
+    # Candidates with identical current content (copied docs, or several missing
+    # files that all fetch as "") would get the same draft, so draft each distinct
+    # content once and share the result.
+    groups: Dict[str, List[str]] = {}
     for fp, score in hits:
         logger.info("Processing candidate file: %s (score=%.4f)", fp, score)
-        current_content = _get_file_from_github(repo_full, fp)
-        try:
-            new_content = ghost_writer.draft_readme_update(diff_text, current_content)
-            if new_content and new_content.strip() != current_content.strip():
-                file_updates[fp] = new_content
-            else:
-                logger.info("No change returned for %s; skipping", fp)
-        except Exception:
-            logger.exception("ghost_writer failed for %s; skipping", fp)
+        groups.setdefault(contents[fp], []).append(fp)
+
+    async def process_one(current_content: str, paths: List[str]) -> Optional[str]:
+        if len(paths) > 1:
+            logger.info("Drafting once for %d files with identical content: %s", len(paths), paths)
+        async with sem:
+            new_content = await _triage_and_draft(diff_text, current_content)
+        if new_content is None:
+            logger.info("No change returned for %s; skipping", ", ".join(paths))
+        return new_content
+
+    results = await asyncio.gather(*[process_one(c, paths) for c, paths in groups.items()], return_exceptions=True)
+    by_path = {fp: result for paths, result in zip(groups.values(), results) for fp in paths}
+
+    # Walk hits so updates stay in search ranking order
+    for fp, _ in hits:
+        result = by_path[fp]
+        if isinstance(result, Exception):
+            logger.error("ghost_writer failed for %s; skipping", fp, exc_info=result)
+        elif result is not None:
+            file_updates[fp] = result
 
     # If no per-file updates found, as a fallback attempt to update top-level README
     if not file_updates:
         logger.info("No file-level updates produced; attempting top-level README fallback")
-        current_readme = _get_readme_from_github(repo_full)
+        current_readme = await asyncio.to_thread(_get_readme_from_github, repo_full)
         try:
-            draft = ghost_writer.draft_readme_update(diff_text, current_readme)
-            if draft and draft.strip() != current_readme.strip():
+            draft = await _triage_and_draft(diff_text, current_readme)
+            if draft is not None:
                 file_updates["README.md"] = draft
         except Exception:
             logger.exception("Fallback README update failed; returning empty mapping")
@@ -1,140 +1,438 @@
 import os
-import math
-from typing import List, Tuple, Optional
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Tuple, Optional
 
+import numpy as np
+import orjson
 import pymongo
+from pymongo.errors import ConnectionFailure, OperationFailure
 import logging
+import redis
 import voyageai
+from motor.motor_asyncio import AsyncIOMotorClient
 
 logger = logging.getLogger(__name__)
 
+_motor_client: Optional[AsyncIOMotorClient] = None
+_redis_client: Optional[redis.Redis] = None
+_voyage_client: Optional[voyageai.Client] = None
 
-def get_mongo_db():
-    uri = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
-    client = pymongo.MongoClient(uri)
-    db_name = os.environ.get("MONGO_DB", "BlastRadius")
-    db = client[db_name]
-    
-    # Log all collections in the database
+# repo_name -> (change marker, ChunkMatrix) for the client-side scoring fallback
+_matrix_cache: Dict[str, Tuple[Tuple[Any, ...], Optional["ChunkMatrix"]]] = {}
+
+# Embedding cache entries expire after a day; GitHub redeliveries land well inside that
+EMBED_CACHE_TTL = 86400
+
+# In-process LRU in front of Redis, for retries within the same worker
+LOCAL_EMBED_CACHE_SIZE = 512
+_local_embed_cache: "OrderedDict[str, Tuple[float, ...]]" = OrderedDict()
+# embed_text runs in worker threads (asyncio.to_thread), so LRU updates need a lock
+_local_embed_lock = threading.Lock()
+
+# Max texts per Voyage embed request
+EMBED_BATCH_SIZE = 128
+
+
+# Keep warm sockets around between webhooks and compress wire traffic
+# (embeddings dominate result size). zlib ships with Python, so no extra
+# compression package is needed.
+MONGO_CLIENT_OPTIONS: Dict[str, Any] = {
+    "maxPoolSize": 50,
+    "minPoolSize": 10,
+    "maxIdleTimeMS": 300_000,
+    "serverSelectionTimeoutMS": 5000,
+    "compressors": "zlib",
+    "retryWrites": True,
+    "appname": "blastradius",
+}
+
+
+def get_motor_db():
+    """Return the async database handle backed by a process-wide Motor client.
+
+    The client owns a connection pool, so it is created once and reused by every
+    webhook instead of reconnecting per query.
+    """
+    global _motor_client
+    if _motor_client is None:
+        uri = os.environ.get("MONGO_URI", "mongodb://localhost:27017")
+        _motor_client = AsyncIOMotorClient(uri, **MONGO_CLIENT_OPTIONS)
+    return _motor_client[os.environ.get("MONGO_DB", "BlastRadius")]
+
+
+# Fields needed to score a chunk: either a float `embedding` list or an int8
+# `emb_q` blob (raw int8 bytes, value = q * `emb_scale`). When a doc has both,
+# only the 1-byte-per-dim `emb_q` is sent (MongoDB 4.4+ projection). Indexers
+# must keep the float `embedding` alongside it: `$vectorSearch` indexes that
+# field, and a doc without it is invisible to the main search path.
+CHUNK_PROJECTION = {
+    "file_path": 1,
+    "emb_q": 1,
+    "emb_scale": 1,
+    "embedding": {"$cond": [{"$ifNull": ["$emb_q", False]}, "$$REMOVE", "$embedding"]},
+}
+
+
+def _chunk_query(repo_name: str) -> Dict[str, Any]:
+    return {
+        "repo_name": repo_name,
+        # $type matches only real vectors, not the null placeholders $exists accepts;
+        # the repo_name prefix of CHUNK_INDEX narrows the scan before this filter
+        "$or": [{"embedding": {"$type": "array"}}, {"emb_q": {"$type": "binData"}}],
+    }
+
+
+# Compound index serving every readme_chunks lookup: repo filter, file grouping
+CHUNK_INDEX = [("repo_name", pymongo.ASCENDING), ("file_path", pymongo.ASCENDING)]
+_chunk_index_ensured = False
+
+
+async def ensure_chunk_index_async(col) -> None:
+    """Create the `readme_chunks` lookup index once per process (idempotent).
+
+    Connection failures (Mongo briefly unreachable) are retried on the next
+    call. Anything else, e.g. read-only credentials, won't fix itself, so it is
+    logged once and not attempted again. Runs unawaited at startup too, so no
+    exception escapes.
+    """
+    global _chunk_index_ensured
+    if _chunk_index_ensured:
+        return
     try:
-        collections = db.list_collection_names()
-        logger.info(f"MongoDB URI: {uri}")
-        logger.info(f"Database: {db_name}")
-        logger.info(f"Total collections found: {len(collections)}")
-        logger.info(f"Collections: {collections}")
-        
-        # Log document count for each collection
-        for col_name in collections:
-            count = db[col_name].count_documents({})
-            logger.info(f"  - {col_name}: {count} documents")
+        await col.create_index(CHUNK_INDEX)
+    except ConnectionFailure as e:
+        logger.warning("Could not reach Mongo to ensure readme_chunks index (will retry): %s", e)
+        return
     except Exception as e:
-        logger.error(f"Failed to list MongoDB collections: {e}")
-    
-    return db
+        logger.warning("Could not ensure readme_chunks index; not retrying: %s", e)
+    _chunk_index_ensured = True
 
 
-def embed_text(text: str) -> List[float]:
-    """Return an embedding for `text` using Voyage AI's embeddings API.
+def _doc_embedding(doc: Dict[str, Any]) -> Optional[np.ndarray]:
+    """Return a chunk's embedding as float32, preferring compact int8 storage."""
+    raw = doc.get("emb_q")
+    if raw:
+        return np.frombuffer(raw, dtype=np.int8).astype(np.float32) * doc.get("emb_scale", 1.0)
+    emb = doc.get("embedding")
+    if emb:
+        return np.asarray(emb, dtype=np.float32)
+    return None
+
+
+def get_redis():
+    """Return a Redis client for the embedding cache, or None if `REDIS_URL` is unset."""
+    global _redis_client
+    if _redis_client is None:
+        url = os.environ.get("REDIS_URL")
+        if not url:
+            return None
+        _redis_client = redis.Redis.from_url(url, socket_timeout=2)
+    return _redis_client
+
+
+def get_voyage_client() -> Optional[voyageai.Client]:
+    """Return the shared Voyage AI client, or None if `VOYAGE_API_KEY` is unset.
+
+    Built on first use (after the caller has loaded `.env`) and reused, so the
+    key is read once and the client's HTTP connections stay warm.
+    """
+    global _voyage_client
+    if _voyage_client is None:
+        voyage_key = os.environ.get("VOYAGE_API_KEY")
+        if not voyage_key:
+            return None
+        _voyage_client = voyageai.Client(api_key=voyage_key)
+    return _voyage_client
+
+
+def _embed_cache_key(model: str, text: str) -> str:
+    return f"emb:{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+
+def _local_cache_get(key: str) -> Optional[List[float]]:
+    with _local_embed_lock:
+        emb = _local_embed_cache.get(key)
+        if emb is None:
+            return None
+        _local_embed_cache.move_to_end(key)
+    return list(emb)
+
+
+def _local_cache_put(key: str, embedding: List[float]) -> None:
+    emb = tuple(embedding)
+    with _local_embed_lock:
+        _local_embed_cache[key] = emb
+        _local_embed_cache.move_to_end(key)
+        if len(_local_embed_cache) > LOCAL_EMBED_CACHE_SIZE:
+            _local_embed_cache.popitem(last=False)
+
+
+def _cache_get_many(keys: List[str]) -> List[Optional[List[float]]]:
+    r = get_redis()
+    if r is None or not keys:
+        return [None] * len(keys)
+    try:
+        raws = r.mget(keys)
+    except redis.RedisError:
+        logger.warning("Embedding cache read failed; calling Voyage", exc_info=True)
+        return [None] * len(keys)
+    return [orjson.loads(raw) if raw is not None else None for raw in raws]
+
+
+def _cache_set_many(items: List[Tuple[str, List[float]]]) -> None:
+    r = get_redis()
+    if r is None or not items:
+        return
+    try:
+        pipe = r.pipeline(transaction=False)
+        for key, embedding in items:
+            pipe.set(key, orjson.dumps(embedding), ex=EMBED_CACHE_TTL)
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning("Embedding cache write failed", exc_info=True)
+
+
+def _local_embedding(text: str) -> List[float]:
+    # Local deterministic fallback (for dev without any API keys): bucket each
+    # character's (codepoint % 97) / 97 into position % 128, then L2-normalise
+    codes = np.fromiter(map(ord, text[:4096]), dtype=np.int64)
+    weights = (codes % 97) / 97.0
+    vec = np.bincount(np.arange(codes.size) % 128, weights=weights, minlength=128)
+    norm = np.linalg.norm(vec) or 1.0
+    return (vec / norm).tolist()
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Return embeddings for `texts` using as few Voyage AI calls as possible.
+
+    Voyage results are cached by `sha256(text)` in an in-process LRU and, when
+    `REDIS_URL` is set, in Redis for `EMBED_CACHE_TTL` seconds. Only cache
+    misses are sent, in batches of up to `EMBED_BATCH_SIZE` per request.
 
     Falls back to a deterministic local hashed-vector if no API key is set
     (useful for offline testing). The production path expects `VOYAGE_API_KEY`
     to be set and an available `voyage-code-3` (1024-dim) or similar model.
     """
     # Use Voyage AI for embeddings
-    voyage_key = os.environ.get("VOYAGE_API_KEY")
+    vo = get_voyage_client()
     model = os.environ.get("EMBEDDING_MODEL", "voyage-code-3")
-    if voyage_key:
-        try:
-            vo = voyageai.Client(api_key=voyage_key)
-            embedding = vo.embed([text], model=model, input_type="query").embeddings[0]
-            return embedding
-        except Exception as e:
-            logger.exception(f"Voyage AI embedding call failed: {e}; falling back to local embedding")
-
-    # Local deterministic fallback (for dev without any API keys)
-    vec = [0.0] * 128
-    for i, ch in enumerate(text[:4096]):
-        vec[i % 128] += (ord(ch) % 97) / 97.0
-    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
-    return [x / norm for x in vec]
-
-
-def _cosine_sim(a: List[float], b: List[float]) -> float:
-    if not a or not b:
-        return -1.0
-    # allow differing dimensions by using min length
-    n = min(len(a), len(b))
-    dot = sum(a[i] * b[i] for i in range(n))
-    na = math.sqrt(sum(a[i] * a[i] for i in range(n)))
-    nb = math.sqrt(sum(b[i] * b[i] for i in range(n)))
-    if na == 0 or nb == 0:
-        return -1.0
-    return dot / (na * nb)
-
-
-def find_relevant_docs(diff_text: str, repo_name: str, top_k: int = 6, min_score: Optional[float] = None) -> List[Tuple[str, float]]:
+    if vo is None:
+        return [_local_embedding(t) for t in texts]
+
+    # Identical patches (redeliveries, retries) reuse the cached vector: the
+    # in-process LRU first, then Redis for whatever it doesn't hold
+    keys = [_embed_cache_key(model, t) for t in texts]
+    results = [_local_cache_get(k) for k in keys]
+    remote = [i for i, emb in enumerate(results) if emb is None]
+    for i, emb in zip(remote, _cache_get_many([keys[i] for i in remote])):
+        if emb is not None:
+            results[i] = emb
+            _local_cache_put(keys[i], emb)
+    missing = [i for i, emb in enumerate(results) if emb is None]
+    if not missing:
+        return results
+
+    try:
+        fresh = []
+        for start in range(0, len(missing), EMBED_BATCH_SIZE):
+            batch = [texts[i] for i in missing[start:start + EMBED_BATCH_SIZE]]
+            fresh.extend(vo.embed(batch, model=model, input_type="query").embeddings)
+        for i, emb in zip(missing, fresh):
+            results[i] = emb
+            _local_cache_put(keys[i], emb)
+        _cache_set_many([(keys[i], results[i]) for i in missing])
+    except Exception as e:
+        logger.exception("Voyage AI embedding call failed: %s; falling back to local embedding", e)
+        for i in missing:
+            results[i] = _local_embedding(texts[i])
+    return results
+
+
+def embed_text(text: str) -> List[float]:
+    """Return an embedding for a single `text`; see `embed_texts`."""
+    return embed_texts([text])[0]
+
+
+def _vector_search_pipeline(query_emb: List[float], repo_name: str, top_k: int) -> List[Dict[str, Any]]:
+    """Atlas `$vectorSearch` pipeline returning the best chunk score per file."""
+    return [
+        {"$vectorSearch": {
+            "index": os.environ.get("VECTOR_INDEX", "vector_index"),
+            "path": "embedding",
+            "queryVector": query_emb,
+            "numCandidates": max(200, top_k * 20),
+            "limit": top_k * 5,
+            "filter": {"repo_name": repo_name},
+        }},
+        {"$group": {"_id": "$file_path", "score": {"$max": {"$meta": "vectorSearchScore"}}}},
+        {"$sort": {"score": -1}},
+        {"$limit": top_k},
+    ]
+
+
+def _vector_search_results(rows: List[Dict[str, Any]], min_score: Optional[float]) -> List[Tuple[str, float]]:
+    # Atlas reports cosine as (1 + cos) / 2; map back so scores (and min_score)
+    # mean the same thing as in the client-side fallback.
+    results = [(r["_id"], 2.0 * r["score"] - 1.0) for r in rows if r["_id"] is not None]
+    if min_score is not None:
+        results = [r for r in results if r[1] >= min_score]
+    return results
+
+
+async def find_relevant_docs_async(diff_text: str, repo_name: str, top_k: int = 6, min_score: Optional[float] = None) -> List[Tuple[str, float]]:
     """Return a list of `(file_path, score)` ordered by relevance for `diff_text`.
 
-    This loads embeddings from the `readme_chunks` collection for `repo_name`,
-    computes cosine similarity against an embedding for `diff_text`, and
-    returns the top-k file paths to consider updating.
+    Mongo I/O goes through Motor and the Voyage call runs in a worker thread, so
+    other webhook deliveries keep making progress while this one waits.
+
+    Runs an Atlas `$vectorSearch` over `readme_chunks` filtered to `repo_name`,
+    aggregating chunks by `file_path` (max score wins) inside the pipeline, so
+    only the top-k file scores cross the network.
 
     Notes:
-    - Documents may contain multiple chunks from the same file; results are
-      aggregated by `file_path` (max score wins) to produce file-level ranking.
-    - For production with large repos, replace the in-process scoring with a
-      proper vector index (MongoDB Atlas `$vectorSearch`, Milvus, Pinecone, etc.).
+    - Requires an Atlas vector index (env `VECTOR_INDEX`, default `vector_index`) on
+      `embedding` with `repo_name` declared as a filter field.
+    - If `$vectorSearch` fails (self-hosted Mongo, or a query vector of the
+      wrong width) or returns no rows (the index is missing or misnamed),
+      falls back to scoring every chunk client-side. The chunk matrix is
+      cached per repo and only reloaded when `_chunk_marker_pipeline` reports
+      a change.
     """
-    db = get_mongo_db()
-    col = db["readme_chunks"]
-
-    # First check all unique repo_names in the collection
-    all_repos = col.distinct("repo_name")
-    logger.info(f"Available repos in MongoDB: {all_repos}")
-
-    query = {"repo_name": repo_name, "embedding": {"$exists": True}}
-    projection = {"file_path": 1, "embedding": 1}
-    cursor = col.find(query, projection)
-    
-    # Convert cursor to list to check if data is accessible
-    docs = list(cursor)
-    logger.info(f"MongoDB query returned {len(docs)} documents for repo '{repo_name}'")
+    col = get_motor_db()["readme_chunks"]
+    query_emb, _ = await asyncio.gather(
+        asyncio.to_thread(embed_text, diff_text),
+        ensure_chunk_index_async(col)
+    )
+
+    try:
+        rows = await col.aggregate(_vector_search_pipeline(query_emb, repo_name, top_k)).to_list(length=top_k)
+    except OperationFailure as e:
+        logger.warning("$vectorSearch unavailable (%s); scoring chunks client-side", e)
+    else:
+        if rows:
+            return _vector_search_results(rows, min_score)
+        # Atlas doesn't error on a missing or misnamed search index; it just
+        # returns nothing, which is indistinguishable from an unindexed repo
+        logger.warning("$vectorSearch returned no rows for '%s'; scoring chunks client-side", repo_name)
+
+    marker = _chunk_marker(await col.aggregate(_chunk_marker_pipeline(repo_name)).to_list(length=1))
+    cached = _matrix_cache.get(repo_name)
+    if cached is not None and cached[0] == marker:
+        return _score_chunk_matrix(cached[1], query_emb, top_k, min_score)
+
+    docs = await col.find(_chunk_query(repo_name), CHUNK_PROJECTION).to_list(length=None)
+    logger.info("MongoDB query returned %d documents for repo '%s'", len(docs), repo_name)
     if len(docs) == 0:
-        logger.warning(f"No documents found in MongoDB for repo '{repo_name}' with embeddings")
-        logger.warning(f"Try using one of these repo names: {all_repos}")
+        all_repos = await col.distinct("repo_name")
+        logger.warning("No documents found in MongoDB for repo '%s' with embeddings", repo_name)
+        logger.warning("Try using one of these repo names: %s", all_repos)
         return []
-    
-    logger.info(f"Sample document keys: {list(docs[0].keys()) if docs else 'N/A'}")
 
-    query_emb = embed_text(diff_text)
+    chunks = _build_chunk_matrix(docs)
+    _matrix_cache[repo_name] = (marker, chunks)
+    return _score_chunk_matrix(chunks, query_emb, top_k, min_score)
 
-    # Score each chunk and keep the best score per file_path
-    best_scores = {}
+
+class ChunkMatrix(NamedTuple):
+    """Chunk embeddings for one repo, laid out for scoring.
+
+    Rows of `matrix` are L2-normalised and grouped by file: rows
+    `starts[i]:starts[i + 1]` all belong to `files[i]`.
+    """
+    matrix: np.ndarray
+    zero_rows: np.ndarray
+    files: np.ndarray
+    starts: np.ndarray
+
+
+def _chunk_marker_pipeline(repo_name: str) -> List[Dict[str, Any]]:
+    """Cheap change marker for a repo's chunks: count, newest `_id` and `updated_at`."""
+    return [
+        {"$match": _chunk_query(repo_name)},
+        {"$group": {
+            "_id": None,
+            "count": {"$sum": 1},
+            "last_id": {"$max": "$_id"},
+            "updated_at": {"$max": "$updated_at"},
+        }},
+    ]
+
+
+def _chunk_marker(rows: List[Dict[str, Any]]) -> Tuple[Any, ...]:
+    if not rows:
+        return (0, None, None)
+    return (rows[0]["count"], rows[0]["last_id"], rows[0].get("updated_at"))
+
+
+def _build_chunk_matrix(docs: List[Dict[str, Any]]) -> Optional[ChunkMatrix]:
+    """Stack chunk docs into a `ChunkMatrix`, or None if none are scorable."""
+    rows = []
     for doc in docs:
-        emb = doc.get("embedding")
-        if not emb:
+        if doc.get("file_path") is None:
             continue
-        score = _cosine_sim(query_emb, emb)
-        fp = doc.get("file_path")
-        if fp is None:
-            continue
-        prev = best_scores.get(fp)
-        if prev is None or score > prev:
-            best_scores[fp] = score
+        emb = _doc_embedding(doc)
+        if emb is not None and emb.size:
+            rows.append((doc["file_path"], emb))
+    if not rows:
+        return None
 
-    # Convert to sorted list
-    results = sorted(best_scores.items(), key=lambda kv: kv[1], reverse=True)
+    # Chunks indexed with a different model have a different width; score the
+    # dominant width and skip the rest rather than comparing unrelated spaces.
+    dim = max({len(emb) for _, emb in rows}, key=lambda d: sum(len(emb) == d for _, emb in rows))
+    skipped = sum(len(emb) != dim for _, emb in rows)
+    if skipped:
+        logger.warning("Skipping %d chunks whose embedding width differs from %d", skipped, dim)
+        rows = [(fp, emb) for fp, emb in rows if len(emb) == dim]
 
-    if min_score is not None:
-        results = [r for r in results if r[1] >= min_score]
+    # Group rows by file once so scoring can reduce each run in C
+    files, inverse = np.unique([fp for fp, _ in rows], return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    starts = np.searchsorted(inverse[order], np.arange(len(files)))
+    matrix = np.stack([rows[i][1] for i in order])
+
+    # L2-normalise once so the matmul yields cosine similarity directly
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+    return ChunkMatrix(matrix, norms[:, 0] == 0, files, starts)
+
+
+def _score_chunk_matrix(chunks: Optional[ChunkMatrix], query_emb: List[float], top_k: int, min_score: Optional[float]) -> List[Tuple[str, float]]:
+    """Score `chunks` against `query_emb` and return the top files (max score per file)."""
+    if chunks is None or not len(query_emb):
+        return []
 
-    return results[:top_k]
+    matrix = chunks.matrix
+    query = np.asarray(query_emb, dtype=np.float32)
+    # Compare on the shared prefix when the query and stored widths differ
+    n = min(matrix.shape[1], len(query))
+    query = query[:n]
+    if n < matrix.shape[1]:
+        matrix = matrix[:, :n]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+    q_norm = np.linalg.norm(query)
+    if q_norm == 0:
+        return []
+    scores = matrix @ (query / q_norm)
+    scores[chunks.zero_rows] = -1.0
+
+    # Best score per file_path
+    best = np.maximum.reduceat(scores, chunks.starts)
+
+    ranked = np.argsort(-best, kind="stable")
+    if min_score is not None:
+        ranked = ranked[best[ranked] >= min_score]
+    return [(str(chunks.files[i]), float(best[i])) for i in ranked[:top_k]]
 
 
 if __name__ == "__main__":
     # Quick manual test: set env MONGO_URI and OPENAI_API_KEY as needed.
     sample_diff = "Added new authentication parameter `api_key` to the login endpoint."
     logger.info("Searching for relevant docs...")
-    hits = find_relevant_docs(sample_diff, repo_name="blastradius-demo")
+    hits = asyncio.run(find_relevant_docs_async(sample_diff, repo_name="blastradius-demo"))
     for path, score in hits:
         logger.info("%0.4f\t%s", score, path)